@@ -5,14 +5,40 @@ Screens FDA-approved drugs against SARS-CoV-2 Main Protease (Mpro)
 """
 
 import subprocess
+import glob
+import hashlib
 import json
+import multiprocessing
 import os
+import re
 import sys
+import tempfile
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
 from pathlib import Path
 
+try:
+    import orjson
+    HAS_ORJSON = True
+except ImportError:
+    HAS_ORJSON = False
+
+# Docking engine: "vina" (default, CPU) or "autodock-gpu". The GPU engine
+# needs AutoGrid4 maps for the receptor at data/targets/6lu7.maps.fld.
+DOCK_ENGINE = os.environ.get("NEXUS_DOCK_ENGINE", "vina")
+
+# Top-mode affinity in Vina's result table ("   1       -7.123  ...")
+_VINA_AFFINITY_RE = re.compile(r"(?m)^\s*1\s+(-?\d+\.\d+)")
+# Per-run energies in an AutoDock-GPU .dlg
+_DLG_ENERGY_RE = re.compile(
+    r"(?m)^DOCKED: USER    Estimated Free Energy of Binding\s*=\s*([-+]?\d+(?:\.\d+)?(?:[eE][-+]?\d+)?)")
+
+# Ligands per obabel run - small enough that docking starts early,
+# large enough to amortize obabel startup
+CONVERT_CHUNK = 4
+
 # Add scripts to path
 sys.path.insert(0, str(Path(__file__).parent))
-from deterministic_admet import compute_deterministic_admet, hash_admet
+from deterministic_admet import canonical_smiles, compute_admet_batch, hash_admet
 
 # FDA-approved drugs with known SMILES (subset for demo)
 # These are real drugs currently on the market
@@ -59,56 +85,177 @@ FDA_DRUGS = [
     ("Fluvoxamine", "COCCCC/C(=N\\OCCN)C1=CC=C(C=C1)C(F)(F)F", "SSRI"),
 ]
 
-def smiles_to_pdbqt(smiles: str, name: str, output_dir: str) -> str:
-    """Convert SMILES to PDBQT using OpenBabel"""
-    output_path = f"{output_dir}/{name}.pdbqt"
-    
-    if os.path.exists(output_path):
-        return output_path
+# Column view of the library
+NAMES, SMILES, CATEGORIES = (list(col) for col in zip(*FDA_DRUGS))
+
+def _pdbqt_title(path: str) -> str:
+    """Molecule title from the "REMARK  Name = ..." header OpenBabel writes"""
+    with open(path) as f:
+        for line in f:
+            if line.startswith("REMARK  Name = "):
+                return line[len("REMARK  Name = "):].strip()
+            if not line.startswith("REMARK"):
+                return None
+    return None
+
+def smiles_to_pdbqt_batch(smiles_names: list, output_dir: str) -> dict:
+    """
+    Convert (SMILES, name) pairs to PDBQT with a single OpenBabel run.
+    Returns {name: path}, with None for ligands that failed to convert.
+    """
+    paths = {name: f"{output_dir}/{name}.pdbqt" for _, name in smiles_names}
+    pending = [(smiles, name) for smiles, name in smiles_names if not os.path.exists(paths[name])]
     
-    # Use obabel to convert SMILES to 3D PDBQT
-    cmd = f'obabel -:"{smiles}" -O {output_path} --gen3d -h 2>/dev/null'
-    result = subprocess.run(cmd, shell=True, capture_output=True)
+    if pending:
+        with tempfile.TemporaryDirectory(dir=output_dir) as tmp:
+            # SMILES go through a file, never a shell command line
+            smi_file = f"{tmp}/batch.smi"
+            with open(smi_file, "w") as f:
+                for smiles, name in pending:
+                    f.write(f"{smiles}\t{name}\n")
+            
+            # -m splits the output into one numbered file per input record
+            subprocess.run([
+                "obabel", smi_file, "-O", f"{tmp}/lig.pdbqt", "--gen3d", "-h", "-m"
+            ], capture_output=True)
+            
+            for out in glob.glob(f"{tmp}/lig*.pdbqt"):
+                name = _pdbqt_title(out)
+                if name in paths and os.path.getsize(out) > 0:
+                    os.replace(out, paths[name])
+            
+            # OpenBabel stops reading at the first SMILES it can't parse, so every
+            # record after a bad one is missing - convert those one at a time
+            for smiles, name in pending:
+                if os.path.exists(paths[name]):
+                    continue
+                out = f"{tmp}/{name}.pdbqt"
+                subprocess.run([
+                    "obabel", f"-:{smiles}", "-O", out, "--gen3d", "-h"
+                ], capture_output=True)
+                if os.path.exists(out) and os.path.getsize(out) > 0:
+                    os.replace(out, paths[name])
     
-    if os.path.exists(output_path) and os.path.getsize(output_path) > 0:
-        return output_path
-    return None
+    return {name: path if os.path.exists(path) else None for name, path in paths.items()}
 
-def run_docking(receptor: str, ligand: str, center: tuple, size: tuple, seed: int) -> dict:
-    """Run Vina docking and return results"""
-    output_path = "/tmp/dock_result.pdbqt"
+def write_receptor_maps(receptor: str, center: tuple, size: tuple, maps: str) -> str:
+    """
+    Compute the Vina grid maps for the docking box once and cache them on disk.
+    The cache is keyed on the receptor contents and the box, so changing either
+    builds fresh maps. Returns the prefix to pass to --maps.
+    """
+    with open(receptor, "rb") as f:
+        digest = hashlib.sha256(f.read())
+    digest.update(repr((tuple(center), tuple(size))).encode())
+    prefix = f"{maps}_{digest.hexdigest()[:12]}"
     
-    cmd = [
+    # Written last, so an interrupted run never leaves maps that look complete
+    marker = f"{prefix}.complete"
+    if os.path.exists(marker):
+        return prefix
+    
+    subprocess.run([
         "./vina_1.2.5_linux_x86_64",
         "--receptor", receptor,
-        "--ligand", ligand,
         "--center_x", str(center[0]),
         "--center_y", str(center[1]),
         "--center_z", str(center[2]),
         "--size_x", str(size[0]),
         "--size_y", str(size[1]),
         "--size_z", str(size[2]),
+        "--force_even_voxels",
+        "--write_maps", prefix,
+    ], capture_output=True, check=True)
+    open(marker, "w").close()
+    return prefix
+
+def run_docking(maps: str, ligand: str, seed: int) -> dict:
+    """Run Vina docking against precomputed maps and return results"""
+    # One output per ligand - several dockings run concurrently
+    output_path = f"/tmp/dock_{Path(ligand).stem}.pdbqt"
+    
+    # The box is baked into the maps, so no receptor or box flags
+    cmd = [
+        "./vina_1.2.5_linux_x86_64",
+        "--maps", maps,
+        "--ligand", ligand,
         "--seed", str(seed),
         "--exhaustiveness", "8",
         "--num_modes", "1",
+        "--cpu", "1",  # parallelism comes from the worker pool
         "--out", output_path,
     ]
     
     result = subprocess.run(cmd, capture_output=True, text=True)
     
     # Parse affinity
+    m = _VINA_AFFINITY_RE.search(result.stdout)
+    affinity = float(m.group(1)) if m else None
+    
+    return {"affinity": affinity, "stdout": result.stdout, "stderr": result.stderr}
+
+def run_docking_gpu(maps_fld: str, ligand: str, seed: int) -> dict:
+    """Run AutoDock-GPU against precomputed AutoGrid4 maps and return results"""
+    resnam = f"/tmp/dock_{Path(ligand).stem}"
+    
+    cmd = [
+        "autodock_gpu_256wi",
+        "--ffile", maps_fld,
+        "--lfile", ligand,
+        "--nrun", "50",
+        "--seed", str(seed),
+        "--resnam", resnam,
+        "--xmloutput", "0",
+    ]
+    
+    result = subprocess.run(cmd, capture_output=True, text=True)
+    
+    # Parse affinity - best estimated free energy over all runs
     affinity = None
-    for line in result.stdout.split('\n'):
-        parts = line.split()
-        if len(parts) >= 2 and parts[0] == '1':
-            try:
-                affinity = float(parts[1])
-            except:
-                pass
-            break
+    dlg_path = f"{resnam}.dlg"
+    if os.path.exists(dlg_path):
+        with open(dlg_path) as f:
+            energies = _DLG_ENERGY_RE.findall(f.read())
+        if energies:
+            affinity = min(map(float, energies))
     
     return {"affinity": affinity, "stdout": result.stdout, "stderr": result.stderr}
 
+def _det_seed(s: str) -> int:
+    """Seed from SHA256, stable across processes (unlike hash(), which is salted per run)"""
+    return int.from_bytes(hashlib.sha256(s.encode()).digest()[:4], "little") & 0x7FFFFFFF
+
+def _available_cpus() -> int:
+    """Cores this process may run on - fewer than cpu_count() under a cpuset/cgroup"""
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+def _pin_worker(counter):
+    """Pin each pool worker to its own core so workers don't thrash"""
+    if not hasattr(os, "sched_setaffinity"):
+        return
+    cpus = sorted(os.sched_getaffinity(0))
+    with counter.get_lock():
+        slot = counter.value
+        counter.value += 1
+    os.sched_setaffinity(0, {cpus[slot % len(cpus)]})
+
+def screen_one(name: str, maps: str, ligand_path: str, engine: str = "vina") -> dict:
+    """Dock a single converted drug. Failures are reported in "error"."""
+    # Generate deterministic seed
+    seed = _det_seed(f"covid-mpro-{name}")
+    
+    # Run docking
+    if engine == "autodock-gpu":
+        dock_result = run_docking_gpu(f"{maps}.maps.fld", ligand_path, seed)
+    else:
+        dock_result = run_docking(maps, ligand_path, seed)
+    
+    if dock_result["affinity"] is None:
+        return {"name": name, "error": "docking failed"}
+    return {"name": name, "affinity": dock_result["affinity"], "seed": seed}
+
 def main():
     print("=" * 70)
     print("NEXUS COVID-19 DRUG REPURPOSING SCREEN")
@@ -117,6 +264,7 @@ def main():
     
     # Setup paths
     receptor = "data/targets/6lu7_receptor.pdbqt"
+    maps = "data/targets/6lu7"
     ligand_dir = "data/ligands"
     os.makedirs(ligand_dir, exist_ok=True)
     
@@ -128,53 +276,114 @@ def main():
     
     print(f"\nScreening {len(FDA_DRUGS)} FDA-approved drugs...\n")
     
-    for i, (name, smiles, category) in enumerate(FDA_DRUGS):
-        print(f"[{i+1}/{len(FDA_DRUGS)}] {name}...", end=" ", flush=True)
-        
-        # Convert to PDBQT
-        ligand_path = smiles_to_pdbqt(smiles, name.replace(" ", "_"), ligand_dir)
-        
-        if not ligand_path:
-            print("❌ conversion failed")
-            continue
-        
-        # Generate deterministic seed
-        seed = hash(f"covid-mpro-{name}") & 0x7FFFFFFF
-        
-        # Run docking
-        dock_result = run_docking(receptor, ligand_path, center, size, seed)
-        
-        if dock_result["affinity"] is None:
-            print("❌ docking failed")
-            continue
-        
-        # Compute ADMET
-        admet = compute_deterministic_admet(smiles)
-        
-        if admet is None:
-            print("❌ ADMET failed")
+    # Docking gets every usable core. The unpinned obabel runs only overlap the
+    # first few dockings, so they oversubscribe briefly instead of holding
+    # cores idle for the rest of the screen.
+    cpus = _available_cpus()
+    conv_workers = max(1, cpus // 2)
+    
+    # The receptor never changes - build its grid maps once for every docking
+    if DOCK_ENGINE == "autodock-gpu":
+        if not os.path.exists(f"{maps}.maps.fld"):
+            sys.exit(f"AutoDock-GPU needs AutoGrid4 maps at {maps}.maps.fld")
+        # A single GPU is shared by every docking - runs are queued, not parallel
+        dock_workers = 1
+    else:
+        # Workers all read the same map files, shared through the OS page cache
+        maps = write_receptor_maps(receptor, center, size, maps)
+        # One worker per usable core, so pinning never doubles up on a core
+        dock_workers = cpus
+    
+    # Canonicalize once - structures listed under several names are screened once
+    canon = [canonical_smiles(s) for s in SMILES]
+    aliases = {}  # canonical SMILES -> indices of every drug with that structure
+    for i, smiles in enumerate(canon):
+        if smiles is None:
+            print(f"[parse] {NAMES[i]}... ❌ invalid SMILES")
             continue
+        aliases.setdefault(smiles, []).append(i)
+    unique = [idx[0] for idx in aliases.values()]
+    
+    # ADMET for the whole library in one batch; drugs it fails on are not docked
+    admets = dict(zip(unique, compute_admet_batch([SMILES[i] for i in unique])))
+    for i in unique:
+        if admets[i] is None:
+            print(f"[ADMET] {NAMES[i]}... ❌ ADMET failed")
+    unique = [i for i in unique if admets[i] is not None]
+    
+    # Pipeline: obabel chunks on a thread pool feed Vina on a process pool.
+    # A chunk's dockings start as soon as it is converted, and each finished
+    # docking is combined with its ADMET here while both pools keep working.
+    chunks = [unique[k:k + CONVERT_CHUNK] for k in range(0, len(unique), CONVERT_CHUNK)]
+    with ThreadPoolExecutor(max_workers=conv_workers) as converters, \
+         ProcessPoolExecutor(max_workers=dock_workers,
+                             initializer=_pin_worker,
+                             initargs=(multiprocessing.Value("i", 0),)) as dockers:
+        # Start the docking workers while this is still the only thread - forking
+        # once converter threads are inside subprocess.run can deadlock
+        dockers.submit(os.getpid).result()
         
-        # Combine results
-        result = {
-            "rank": 0,
-            "name": name,
-            "category": category,
-            "smiles": smiles,
-            "affinity": dock_result["affinity"],
-            "mw": float(admet["mw"]),
-            "logp": float(admet["logp"]),
-            "qed": float(admet["qed"]),
-            "lipinski": admet["lipinski_pass"] == "true",
-            "bbb": admet["bbb_permeable"] == "true",
-            "gi": admet["gi_absorption"],
+        conversions = {
+            converters.submit(smiles_to_pdbqt_batch,
+                              [(SMILES[i], NAMES[i].replace(" ", "_")) for i in chunk],
+                              ligand_dir): chunk
+            for chunk in chunks
         }
+        dockings = {}
+        done_count = 0
+        pending = set(conversions)
         
-        results.append(result)
-        print(f"✅ {dock_result['affinity']:.2f} kcal/mol")
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future in conversions:
+                    # Stage 1 -> 2: queue the converted ligands for docking
+                    paths = future.result()
+                    for i in conversions[future]:
+                        ligand_path = paths[NAMES[i].replace(" ", "_")]
+                        if not ligand_path:
+                            print(f"[conversion] {NAMES[i]}... ❌ conversion failed")
+                            continue
+                        docking = dockers.submit(screen_one, NAMES[i], maps, ligand_path, DOCK_ENGINE)
+                        dockings[docking] = aliases[canon[i]]
+                        pending.add(docking)
+                    continue
+                
+                # Stage 3: combine the docking with ADMET
+                done_count += 1
+                result = future.result()
+                print(f"[{done_count}/{len(unique)}] {result['name']}...", end=" ")
+                
+                if "error" in result:
+                    print(f"❌ {result['error']}")
+                    continue
+                
+                admet = admets[dockings[future][0]]
+                
+                # Same structure, same pose - report it under every name, recording
+                # which name's seed produced it so aliases can be re-docked exactly
+                for j in dockings[future]:
+                    results.append({
+                        "rank": 0,
+                        "name": NAMES[j],
+                        "category": CATEGORIES[j],
+                        "smiles": SMILES[j],
+                        "affinity": result["affinity"],
+                        "docked_as": result["name"],
+                        "seed": result["seed"],
+                        "mw": float(admet["mw"]),
+                        "logp": float(admet["logp"]),
+                        "qed": float(admet["qed"]),
+                        "lipinski": admet["lipinski_pass"] == "true",
+                        "bbb": admet["bbb_permeable"] == "true",
+                        "gi": admet["gi_absorption"],
+                    })
+                print(f"✅ {result['affinity']:.2f} kcal/mol")
     
-    # Sort by affinity (more negative = better binding)
-    results.sort(key=lambda x: x["affinity"])
+    # Sort by affinity (more negative = better binding). Results arrive in
+    # completion order, so ties fall back to library order to keep ranks reproducible.
+    library_order = {name: i for i, name in enumerate(NAMES)}
+    results.sort(key=lambda x: (x["affinity"], library_order[x["name"]]))
     
     # Assign ranks
     for i, r in enumerate(results):
@@ -193,8 +402,12 @@ def main():
     
     # Save full results
     output_file = "data/covid_screen_results.json"
-    with open(output_file, "w") as f:
-        json.dump(results, f, indent=2)
+    if HAS_ORJSON:
+        with open(output_file, "wb") as f:
+            f.write(orjson.dumps(results, option=orjson.OPT_INDENT_2 | orjson.OPT_SERIALIZE_NUMPY))
+    else:
+        with open(output_file, "w") as f:
+            json.dump(results, f, indent=2)
     
     print(f"\n✅ Full results saved to {output_file}")
     
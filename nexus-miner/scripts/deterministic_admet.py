@@ -4,58 +4,217 @@ Deterministic ADMET Calculator
 All outputs are canonical strings suitable for hashing.
 """
 
+import functools
 import hashlib
 import json
+import os
+import numpy as np
+import rdkit
 from rdkit import Chem
-from rdkit.Chem import Descriptors, Lipinski, QED, rdMolDescriptors
+from rdkit.Chem import QED, rdMolDescriptors
+
+# Persistent cache: sha256(canonical SMILES) -> ADMET dict, one JSON object per line.
+# Defaults to nexus-miner/data regardless of the working directory.
+# Set NEXUS_ADMET_CACHE="" to disable.
+ADMET_CACHE_PATH = os.environ.get(
+    "NEXUS_ADMET_CACHE",
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data", "admet_cache.jsonl"),
+)
+
+# Bump when descriptors, formatting or rules change. The first line of the cache
+# file records both versions; a file from another RDKit or schema is discarded.
+ADMET_SCHEMA_VERSION = 1
+_CACHE_HEADER = {"rdkit": rdkit.__version__, "schema": ADMET_SCHEMA_VERSION}
+
+
+def _load_cache(path: str):
+    """Cached entries, or None if there is no usable cache file (missing or stale)."""
+    if not path or not os.path.exists(path):
+        return None
+    cache = {}
+    with open(path) as f:
+        try:
+            header = json.loads(f.readline())
+        except ValueError:
+            header = None
+        if header != _CACHE_HEADER:
+            return None
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue  # torn write from an interrupted run
+            cache[entry["key"]] = entry["admet"]
+    return cache
+
+
+_ADMET_CACHE = _load_cache(ADMET_CACHE_PATH)
+# Without a valid header the file is rewritten on the first store
+_CACHE_FILE_VALID = _ADMET_CACHE is not None
+if _ADMET_CACHE is None:
+    _ADMET_CACHE = {}
+
+# Numeric descriptors fetched in a single native call per molecule.
+# amw/CrippenClogP/tpsa/NumHBD/NumHBA are the values behind Descriptors.MolWt,
+# MolLogP, TPSA and Lipinski.NumHDonors/NumHAcceptors.
+_PROPERTIES = rdMolDescriptors.Properties([
+    "amw", "CrippenClogP", "tpsa", "NumHBD", "NumHBA", "NumRotatableBonds",
+    "NumRings", "NumAromaticRings", "NumHeavyAtoms", "FractionCSP3",
+])
+
+
+def _store(key: str, admet: dict):
+    global _CACHE_FILE_VALID
+    _ADMET_CACHE[key] = admet
+    if ADMET_CACHE_PATH:
+        os.makedirs(os.path.dirname(ADMET_CACHE_PATH) or ".", exist_ok=True)
+        with open(ADMET_CACHE_PATH, "a" if _CACHE_FILE_VALID else "w") as f:
+            if not _CACHE_FILE_VALID:
+                f.write(json.dumps(_CACHE_HEADER) + "\n")
+                _CACHE_FILE_VALID = True
+            f.write(json.dumps({"key": key, "admet": admet}) + "\n")
+
+
+@functools.lru_cache(maxsize=4096)
+def _parse(smiles: str):
+    """Parse SMILES once; returns (canonical SMILES, cache key, mol) or None if invalid."""
+    mol = Chem.MolFromSmiles(smiles)
+    if mol is None:
+        return None
+    # Equivalent SMILES share a cache entry
+    canonical = Chem.MolToSmiles(mol)
+    key = hashlib.sha256(canonical.encode()).hexdigest()
+    return canonical, key, mol
+
+
+def canonical_smiles(smiles: str) -> str:
+    """Canonical SMILES for dedup, or None if invalid. Shares the parse with ADMET."""
+    parsed = _parse(smiles)
+    return parsed[0] if parsed is not None else None
+
+
+def compute_admet_batch(smiles_list: list) -> list:
+    """
+    Compute ADMET properties for many SMILES at once.
+    Entries are None for SMILES that fail to parse.
+    Results are cached in memory and on disk, keyed on the canonical SMILES.
+    """
+    results = [None] * len(smiles_list)
+    misses = {}  # cache key -> (mol, indices into results)
+    for n, smiles in enumerate(smiles_list):
+        parsed = _parse(smiles)
+        if parsed is None:
+            continue
+        
+        _, key, mol = parsed
+        admet = _ADMET_CACHE.get(key)
+        if admet is None:
+            misses.setdefault(key, (mol, []))[1].append(n)
+        else:
+            # Callers get their own copy so the cached entry can't be mutated
+            results[n] = dict(admet)
+    
+    if misses:
+        computed = _compute_admet([mol for mol, _ in misses.values()])
+        for (key, (_, indices)), admet in zip(misses.items(), computed):
+            _store(key, admet)
+            for n in indices:
+                results[n] = dict(admet)
+    return results
+
 
 def compute_deterministic_admet(smiles: str) -> dict:
     """
     Compute ADMET properties with deterministic string outputs.
     All floats are formatted to fixed precision.
     """
-    mol = Chem.MolFromSmiles(smiles)
-    if mol is None:
-        return None
+    return compute_admet_batch([smiles])[0]
+
+
+def _describe(mol) -> dict:
+    """Formatted descriptors for an already-parsed molecule."""
+    (mw, logp, tpsa, hbd, hba, rotatable, rings, aromatic_rings,
+     heavy_atoms, fraction_csp3) = _PROPERTIES.ComputeProperties(mol)
     
-    # Compute all properties
-    result = {
+    return {
         # Use fixed decimal places for determinism
-        "mw": f"{Descriptors.MolWt(mol):.3f}",
-        "logp": f"{Descriptors.MolLogP(mol):.3f}", 
-        "tpsa": f"{Descriptors.TPSA(mol):.2f}",
-        "hbd": str(Lipinski.NumHDonors(mol)),
-        "hba": str(Lipinski.NumHAcceptors(mol)),
-        "rotatable": str(Lipinski.NumRotatableBonds(mol)),
-        "rings": str(rdMolDescriptors.CalcNumRings(mol)),
-        "aromatic_rings": str(rdMolDescriptors.CalcNumAromaticRings(mol)),
-        "heavy_atoms": str(mol.GetNumHeavyAtoms()),
+        "mw": f"{mw:.3f}",
+        "logp": f"{logp:.3f}",
+        "tpsa": f"{tpsa:.2f}",
+        "hbd": str(int(hbd)),
+        "hba": str(int(hba)),
+        "rotatable": str(int(rotatable)),
+        "rings": str(int(rings)),
+        "aromatic_rings": str(int(aromatic_rings)),
+        "heavy_atoms": str(int(heavy_atoms)),
         "qed": f"{QED.qed(mol):.4f}",
-        "fraction_csp3": f"{rdMolDescriptors.CalcFractionCSP3(mol):.4f}",
+        "fraction_csp3": f"{fraction_csp3:.4f}",
     }
+
+
+def _admet_masks(mw, logp, tpsa, hbd, hba, rotatable):
+    """Rule-based pass/fail for descriptor columns (arrays) or a single compound (floats)."""
+    lipinski = (mw <= 500) & (logp <= 5) & (hbd <= 5) & (hba <= 10)
+    veber = (rotatable <= 10) & (tpsa <= 140)
+    bbb = (tpsa < 90) & (logp > 0) & (mw < 450)
+    gi = (tpsa <= 131.6) & (logp <= 5.88)
+    return lipinski, veber, bbb, gi
+
+
+# Below this many molecules the NumPy round trip costs more than it saves
+_VECTOR_MIN_BATCH = 16
+
+
+def _compute_admet(mols: list) -> list:
+    """Compute ADMET properties for a batch of already-parsed molecules."""
+    results = [_describe(mol) for mol in mols]
     
-    # Compute derived boolean properties (deterministic)
-    mw = float(result["mw"])
-    logp = float(result["logp"])
-    tpsa = float(result["tpsa"])
-    hbd = int(result["hbd"])
-    hba = int(result["hba"])
-    
-    result["lipinski_pass"] = str(
-        mw <= 500 and logp <= 5 and hbd <= 5 and hba <= 10
-    ).lower()
+    # Derived boolean properties (deterministic). Rules are applied to the
+    # formatted values, so they agree with what gets hashed.
+    if len(results) < _VECTOR_MIN_BATCH:
+        # Small batches (single-compound lookups) - the same rules on plain floats
+        for result in results:
+            lipinski, veber, bbb, gi = _admet_masks(
+                float(result["mw"]), float(result["logp"]), float(result["tpsa"]),
+                float(result["hbd"]), float(result["hba"]), float(result["rotatable"]),
+            )
+            result["lipinski_pass"] = "true" if lipinski else "false"
+            result["veber_pass"] = "true" if veber else "false"
+            result["bbb_permeable"] = "true" if bbb else "false"
+            result["gi_absorption"] = "high" if gi else "low"
+        return results
     
-    result["veber_pass"] = str(
-        int(result["rotatable"]) <= 10 and tpsa <= 140
-    ).lower()
+    def column(key):
+        return np.array([float(r[key]) for r in results])
     
-    result["bbb_permeable"] = str(
-        tpsa < 90 and logp > 0 and mw < 450
-    ).lower()
+    lipinski, veber, bbb, gi = _admet_masks(
+        column("mw"), column("logp"), column("tpsa"),
+        column("hbd"), column("hba"), column("rotatable"),
+    )
     
-    result["gi_absorption"] = "high" if (tpsa <= 131.6 and logp <= 5.88) else "low"
+    flags = zip(
+        np.where(lipinski, "true", "false").tolist(),
+        np.where(veber, "true", "false").tolist(),
+        np.where(bbb, "true", "false").tolist(),
+        np.where(gi, "high", "low").tolist(),
+    )
+    for result, (lip, veb, bbb_ok, gi_abs) in zip(results, flags):
+        result["lipinski_pass"] = lip
+        result["veber_pass"] = veb
+        result["bbb_permeable"] = bbb_ok
+        result["gi_absorption"] = gi_abs
     
-    return result
+    return results
+
+
+# Schema of compute_deterministic_admet, in the sorted order used for hashing
+_ADMET_KEYS = (
+    "aromatic_rings", "bbb_permeable", "fraction_csp3", "gi_absorption",
+    "hba", "hbd", "heavy_atoms", "lipinski_pass", "logp", "mw", "qed",
+    "rings", "rotatable", "tpsa", "veber_pass",
+)
+_ADMET_KEY_SET = frozenset(_ADMET_KEYS)
+_ADMET_KEY_PREFIXES = {k: k.encode() + b"=" for k in _ADMET_KEYS}
 
 
 def hash_admet(admet: dict) -> str:
@@ -63,9 +222,18 @@ def hash_admet(admet: dict) -> str:
     Create deterministic hash of ADMET properties.
     Properties are sorted alphabetically and concatenated.
     """
-    # Sort keys for determinism
-    canonical = "|".join(f"{k}={admet[k]}" for k in sorted(admet.keys()))
-    return hashlib.sha256(canonical.encode()).hexdigest()
+    # Sort keys for determinism (precomputed for the standard schema)
+    keys = _ADMET_KEYS if admet.keys() == _ADMET_KEY_SET else sorted(admet.keys())
+    
+    # Hash "k1=v1|k2=v2|..." incrementally instead of building the string
+    h = hashlib.sha256()
+    sep = b""
+    for k in keys:
+        h.update(sep)
+        h.update(_ADMET_KEY_PREFIXES.get(k) or f"{k}=".encode())
+        h.update(str(admet[k]).encode())
+        sep = b"|"
+    return h.hexdigest()
 
 
 def test_determinism():
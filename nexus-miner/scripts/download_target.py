@@ -3,42 +3,118 @@
 Download and prepare PDB structures for NEXUS docking.
 """
 
+import email.utils
+import http.client
 import json
-import urllib.request
+import mmap
+import threading
+import urllib.error
 import subprocess
 import os
+from concurrent.futures import ThreadPoolExecutor
 
-def download_pdb(pdb_id: str, output_dir: str = "data/targets") -> str:
-    """Download PDB file from RCSB"""
+RCSB_HOST = "files.rcsb.org"
+
+# One keep-alive connection per download thread
+_local = threading.local()
+
+def _rcsb_get(path: str, headers: dict) -> http.client.HTTPResponse:
+    """GET from RCSB over this thread's persistent connection"""
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        conn = _local.conn = http.client.HTTPSConnection(RCSB_HOST, timeout=60)
+    try:
+        conn.request("GET", path, headers=headers)
+        return conn.getresponse()
+    except (http.client.HTTPException, OSError):
+        # Server closed the idle connection - reconnect once
+        conn.close()
+        conn.request("GET", path, headers=headers)
+        return conn.getresponse()
+
+def download_pdb(pdb_id: str, output_dir: str = "data/targets", log=print) -> str:
+    """Download PDB file from RCSB, skipping it if the local copy is current"""
     os.makedirs(output_dir, exist_ok=True)
-    url = f"https://files.rcsb.org/download/{pdb_id}.pdb"
+    path = f"/download/{pdb_id}.pdb"
     output_path = f"{output_dir}/{pdb_id.lower()}.pdb"
     
-    if os.path.exists(output_path):
-        print(f"  {pdb_id}: Already downloaded")
-        return output_path
+    have_local = os.path.exists(output_path)
+    headers = {}
+    if have_local:
+        headers["If-Modified-Since"] = email.utils.formatdate(
+            os.path.getmtime(output_path), usegmt=True)
     
-    print(f"  {pdb_id}: Downloading from RCSB...")
-    urllib.request.urlretrieve(url, output_path)
+    try:
+        resp = _rcsb_get(path, headers)
+        if resp.status == 304:
+            resp.read()
+            log(f"  {pdb_id}: Already downloaded")
+            return output_path
+        if resp.status != 200:
+            resp.read()
+            raise urllib.error.HTTPError(f"https://{RCSB_HOST}{path}", resp.status,
+                                         resp.reason, resp.headers, None)
+        
+        log(f"  {pdb_id}: Downloading from RCSB...")
+        # Write to a temp file so an interrupted download never looks current
+        tmp_path = f"{output_path}.{threading.get_ident()}.part"
+        try:
+            with open(tmp_path, "wb") as f:
+                while chunk := resp.read(65536):
+                    f.write(chunk)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        os.replace(tmp_path, output_path)
+    except (http.client.HTTPException, OSError) as e:
+        # Offline or RCSB unreachable - an existing copy is still usable
+        if not have_local:
+            raise
+        log(f"  {pdb_id}: Update check failed ({e}), using local copy")
     return output_path
 
-def prepare_receptor(pdb_path: str) -> str:
+def _atom_spans(mm):
+    """Yield (start, end) byte offsets of every ATOM line in a mapped PDB/PDBQT"""
+    start = 0 if mm[:4] == b"ATOM" else None
+    pos = 0
+    while True:
+        if start is None:
+            hit = mm.find(b"\nATOM", pos)
+            if hit == -1:
+                return
+            start = hit + 1
+        end = mm.find(b"\n", start)
+        end = len(mm) if end == -1 else end + 1
+        yield start, end
+        # Resume on this line's newline so it can anchor the next ATOM
+        pos = end - 1
+        start = None
+
+def count_atoms(path: str) -> int:
+    """Count ATOM records without decoding the file"""
+    if os.path.getsize(path) == 0:
+        return 0
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        return sum(1 for _ in _atom_spans(mm))
+
+def prepare_receptor(pdb_path: str, log=print) -> str:
     """Convert PDB to PDBQT using OpenBabel"""
     pdbqt_path = pdb_path.replace(".pdb", "_receptor.pdbqt")
     
-    if os.path.exists(pdbqt_path):
-        print(f"  {pdb_path}: PDBQT exists")
+    if os.path.exists(pdbqt_path) and os.path.getmtime(pdbqt_path) >= os.path.getmtime(pdb_path):
+        log(f"  {pdb_path}: PDBQT exists")
         return pdbqt_path
     
     # Extract protein only (ATOM records)
     protein_pdb = pdb_path.replace(".pdb", "_protein.pdb")
-    with open(pdb_path) as f:
-        lines = [l for l in f if l.startswith("ATOM")]
-    with open(protein_pdb, "w") as f:
-        f.writelines(lines)
+    with open(pdb_path, "rb") as f, open(protein_pdb, "wb") as out:
+        if os.path.getsize(pdb_path) > 0:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                for start, end in _atom_spans(mm):
+                    out.write(mm[start:end])
     
     # Convert to PDBQT
-    print(f"  Converting to PDBQT...")
+    log(f"  Converting to PDBQT...")
     subprocess.run([
         "obabel", protein_pdb, "-O", pdbqt_path, "-xr"
     ], capture_output=True)
@@ -46,6 +122,14 @@ def prepare_receptor(pdb_path: str) -> str:
     os.remove(protein_pdb)
     return pdbqt_path
 
+def download_and_prepare(target: dict) -> tuple:
+    """Fetch and convert one target; returns (target, pdbqt path, receptor atoms, status lines)"""
+    # Runs on a pool thread - collect status lines so main() prints them in order
+    status = []
+    pdb_path = download_pdb(target["pdb_id"], log=status.append)
+    pdbqt_path = prepare_receptor(pdb_path, log=status.append)
+    return target, pdbqt_path, count_atoms(pdbqt_path), status
+
 def main():
     print("=" * 60)
     print("NEXUS Target Downloader")
@@ -56,14 +140,15 @@ def main():
     
     print(f"\nDownloading {len(data['targets'])} priority targets...\n")
     
-    for target in data["targets"]:
+    # Downloads are latency-bound - overlap them
+    with ThreadPoolExecutor(max_workers=8) as ex:
+        prepared = list(ex.map(download_and_prepare, data["targets"]))
+    
+    for target, pdbqt_path, atoms, status in prepared:
         print(f"\n{target['name']} ({target['disease']}):")
-        pdb_path = download_pdb(target["pdb_id"])
-        pdbqt_path = prepare_receptor(pdb_path)
-        
-        # Count atoms
-        with open(pdbqt_path) as f:
-            atoms = len([l for l in f if l.startswith("ATOM")])
+        for line in status:
+            print(line)
+        print(f"  Receptor: {pdbqt_path}")
         print(f"  Receptor atoms: {atoms}")
     
     print("\n" + "=" * 60)
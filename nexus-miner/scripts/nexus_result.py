@@ -10,7 +10,13 @@ from dataclasses import dataclass, asdict
 from typing import Optional
 from deterministic_admet import compute_deterministic_admet, hash_admet
 
-@dataclass
+try:
+    import orjson
+    HAS_ORJSON = True
+except ImportError:
+    HAS_ORJSON = False
+
+@dataclass(slots=True, frozen=True)
 class NexusResult:
     """Complete mining result - all fields are deterministic"""
     
@@ -85,6 +91,8 @@ class NexusResult:
         )
     
     def to_json(self) -> str:
+        if HAS_ORJSON:
+            return orjson.dumps(asdict(self), option=orjson.OPT_INDENT_2).decode()
         return json.dumps(asdict(self), indent=2)
     
     def verify(self, other_docking_hash: str, other_smiles: str) -> bool:
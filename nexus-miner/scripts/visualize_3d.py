@@ -9,6 +9,28 @@ import json
 import os
 from pathlib import Path
 
+try:
+    from vina import Vina
+    HAS_VINA = True
+except ImportError:
+    HAS_VINA = False
+
+# COVID Mpro binding site
+MPRO_CENTER = [-10.8, 15.8, 68.5]
+MPRO_BOX = [20, 20, 20]
+
+# Receptor maps are the expensive part of a dock - compute them once per run
+_docker = None
+
+def get_docker():
+    """Vina engine with the Mpro receptor and maps loaded, shared by every pose"""
+    global _docker
+    if _docker is None:
+        _docker = Vina(sf_name="vina", cpu=os.cpu_count(), seed=12345)
+        _docker.set_receptor("data/receptors/6LU7.pdbqt")
+        _docker.compute_vina_maps(center=MPRO_CENTER, box_size=MPRO_BOX)
+    return _docker
+
 # Create output directory
 os.makedirs("output/visualizations/3d", exist_ok=True)
 
@@ -193,19 +215,25 @@ else:
     
     if os.path.exists("data/famotidine.pdbqt"):
         # Run Vina
-        subprocess.run([
-            "./vina_1.2.5_linux_x86_64",
-            "--receptor", "data/receptors/6LU7.pdbqt",
-            "--ligand", "data/famotidine.pdbqt",
-            "--center_x", "-10.8",
-            "--center_y", "15.8", 
-            "--center_z", "68.5",
-            "--size_x", "20",
-            "--size_y", "20",
-            "--size_z", "20",
-            "--out", "data/famotidine_docked.pdbqt",
-            "--seed", "12345"
-        ])
+        if HAS_VINA:
+            v = get_docker()
+            v.set_ligand_from_file("data/famotidine.pdbqt")
+            v.dock(exhaustiveness=8, n_poses=1)
+            v.write_poses("data/famotidine_docked.pdbqt", n_poses=1, overwrite=True)
+        else:
+            subprocess.run([
+                "./vina_1.2.5_linux_x86_64",
+                "--receptor", "data/receptors/6LU7.pdbqt",
+                "--ligand", "data/famotidine.pdbqt",
+                "--center_x", str(MPRO_CENTER[0]),
+                "--center_y", str(MPRO_CENTER[1]),
+                "--center_z", str(MPRO_CENTER[2]),
+                "--size_x", str(MPRO_BOX[0]),
+                "--size_y", str(MPRO_BOX[1]),
+                "--size_z", str(MPRO_BOX[2]),
+                "--out", "data/famotidine_docked.pdbqt",
+                "--seed", "12345"
+            ])
         
         if os.path.exists("data/famotidine_docked.pdbqt"):
             create_3d_view(
@@ -4,16 +4,25 @@ NEXUS Result Visualization
 Generates visual outputs from docking data
 """
 
+import functools
 import json
 import os
+import string
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
 
 # Check what visualization libraries we have
 print("Checking available visualization tools...")
 
 try:
-    import matplotlib.pyplot as plt
     import matplotlib
-    matplotlib.use('Agg')  # For headless rendering
+    matplotlib.use('Agg')  # For headless rendering - must precede the pyplot import
+    import matplotlib.pyplot as plt
+    # Agg fast paths for paths with many vertices
+    matplotlib.rcParams['path.simplify'] = True
+    matplotlib.rcParams['path.simplify_threshold'] = 1.0
+    matplotlib.rcParams['agg.path.chunksize'] = 10000
     print("✅ matplotlib available")
     HAS_MPL = True
 except:
@@ -29,6 +38,26 @@ except:
     print("❌ RDKit drawing not available")
     HAS_RDKIT = False
 
+try:
+    import cairosvg
+    print("✅ cairosvg available (SVG rasterizing)")
+    HAS_CAIROSVG = True
+except:
+    print("❌ cairosvg not installed")
+    HAS_CAIROSVG = False
+
+try:
+    import orjson
+    HAS_ORJSON = True
+except:
+    HAS_ORJSON = False
+
+try:
+    from adjustText import adjust_text
+    HAS_ADJUSTTEXT = True
+except:
+    HAS_ADJUSTTEXT = False
+
 try:
     import py3Dmol
     print("✅ py3Dmol available (3D visualization)")
@@ -37,46 +66,87 @@ except:
     print("❌ py3Dmol not installed")
     HAS_3D = False
 
-# Load results
-with open("data/covid_screen_results.json") as f:
-    results = json.load(f)
+try:
+    import datashader as ds
+    import datashader.transfer_functions as tf
+    import pandas as pd
+    print("✅ datashader available (large scatter plots)")
+    HAS_DATASHADER = True
+except:
+    print("❌ datashader not installed")
+    HAS_DATASHADER = False
 
-print(f"\nLoaded {len(results)} docking results")
+# Point count above which the scatter is shaded into a single image (needs datashader)
+DATASHADER_THRESHOLD = 2000
 
-# Create output directory
-os.makedirs("output/visualizations", exist_ok=True)
+# Point count above which scatter layers are rasterized (axes and text stay vector)
+RASTERIZE_THRESHOLD = 5000
 
-if HAS_MPL:
-    print("\n=== Generating Charts ===")
-    
-    # 1. Bar chart of top 15 binders
+
+def top_k(values, k):
+    """Indices of the k smallest values, best first, ties in file order - no full sort"""
+    if 0 < k < len(values):
+        # Everything up to the k-th smallest value, kept in file order so ties
+        # (including those straddling the cut) resolve to the earlier row
+        kth = np.partition(values, k - 1)[k - 1]
+        idx = np.flatnonzero(values <= kth)
+    else:
+        idx = np.arange(len(values))
+    return idx[np.argsort(values[idx], kind='stable')][:k]
+
+
+# Each chart builds its own Figure from plain arrays so it can run in a worker process
+
+def render_top15(arrs, path):
+    """Bar chart of the top 15 binders"""
+    top15 = arrs['top15']
     fig, ax = plt.subplots(figsize=(12, 8))
-    top15 = results[:15]
-    names = [r['name'][:15] for r in top15]
-    affinities = [r['affinity'] for r in top15]
-    colors = ['green' if r['lipinski'] else 'orange' for r in top15]
+    labels = [arrs['names'][i][:15] for i in top15]
+    affinities = arrs['affinity'][top15]
+    colors = np.where(arrs['lipinski'][top15], 'green', 'orange')
     
-    bars = ax.barh(names, affinities, color=colors)
+    bars = ax.barh(labels, affinities, color=colors)
     ax.set_xlabel('Binding Affinity (kcal/mol)')
     ax.set_title('Top 15 COVID-19 Mpro Binders\n(Green = Lipinski compliant, Orange = Violations)')
     ax.invert_yaxis()
     
-    # Add value labels
-    for bar, val in zip(bars, affinities):
-        ax.text(val - 0.3, bar.get_y() + bar.get_height()/2, 
-                f'{val:.2f}', va='center', ha='right', color='white', fontweight='bold')
+    # Add value labels - one call for every bar, drawn just inside the bar end
+    ax.bar_label(bars, labels=[f'{v:.2f}' for v in affinities], label_type='edge',
+                 padding=-30, color='white', fontweight='bold')
     
     plt.tight_layout()
-    plt.savefig('output/visualizations/top15_binders.png', dpi=150)
-    print("✅ Saved: top15_binders.png")
-    
-    # 2. Affinity vs QED scatter plot
+    plt.savefig(path, dpi=150)
+    plt.close(fig)
+    return path
+
+
+def render_scatter(arrs, path):
+    """Affinity vs QED scatter plot with the top 15 labelled"""
+    affinity, qed, names = arrs['affinity'], arrs['qed'], arrs['names']
     fig, ax = plt.subplots(figsize=(10, 8))
     
-    for r in results:
-        color = 'green' if r['lipinski'] else 'red'
-        ax.scatter(r['affinity'], r['qed'], c=color, s=100, alpha=0.7)
-        ax.annotate(r['name'][:10], (r['affinity'], r['qed']), fontsize=8)
+    if len(affinity) > DATASHADER_THRESHOLD and HAS_DATASHADER:
+        # Bin the whole point cloud into one image - cost scales with pixels, not N
+        x_range = (affinity.min(), affinity.max())
+        y_range = (qed.min(), qed.max())
+        cvs = ds.Canvas(plot_width=1000, plot_height=800, x_range=x_range, y_range=y_range)
+        density = cvs.points(pd.DataFrame({'a': affinity, 'q': qed}), 'a', 'q', ds.count())
+        img = tf.shade(density)
+        ax.imshow(img.to_pil(), extent=[*x_range, *y_range], aspect='auto')
+    else:
+        # One PathCollection for every point instead of one artist per result
+        sc = ax.scatter(affinity, qed, c=np.where(arrs['lipinski'], 'green', 'red'), s=100, alpha=0.7)
+        if len(affinity) > RASTERIZE_THRESHOLD:
+            sc.set_rasterized(True)
+    
+    # Label only the top binders, at a fixed offset (2% of the data range) laid out once
+    dx = 0.02 * (affinity.max() - affinity.min())
+    dy = 0.02 * (qed.max() - qed.min())
+    texts = [ax.annotate(names[i][:10], (affinity[i], qed[i]),
+                         xytext=(affinity[i] + dx, qed[i] + dy), textcoords='data', fontsize=8)
+             for i in arrs['top15']]
+    if HAS_ADJUSTTEXT:
+        adjust_text(texts, ax=ax)
     
     ax.set_xlabel('Binding Affinity (kcal/mol) ← Better')
     ax.set_ylabel('QED (Drug-likeness) ↑ Better')
@@ -89,91 +159,69 @@ if HAS_MPL:
     ax.text(-6.8, 0.75, 'IDEAL\nCANDIDATES', ha='center', fontsize=12, color='green')
     
     plt.tight_layout()
-    plt.savefig('output/visualizations/affinity_vs_qed.png', dpi=150)
-    print("✅ Saved: affinity_vs_qed.png")
-    
-    # 3. Category breakdown
+    plt.savefig(path, dpi=150)
+    plt.close(fig)
+    return path
+
+
+def render_category(arrs, path):
+    """Drug categories ranked by average affinity"""
     fig, ax = plt.subplots(figsize=(10, 6))
     
-    categories = {}
-    for r in results:
-        cat = r['category'].split('(')[0].strip()[:20]
-        if cat not in categories:
-            categories[cat] = []
-        categories[cat].append(r['affinity'])
-    
-    cat_names = list(categories.keys())
-    cat_avgs = [sum(v)/len(v) for v in categories.values()]
-    cat_counts = [len(v) for v in categories.values()]
+    # Running (count, sum) per category - one pass, no per-category lists
+    agg = defaultdict(lambda: [0, 0.0])
+    for category, aff in zip(arrs['categories'], arrs['affinity'].tolist()):
+        a = agg[category.split('(')[0].strip()[:20]]
+        a[0] += 1
+        a[1] += aff
     
     # Sort by average affinity
-    sorted_idx = sorted(range(len(cat_avgs)), key=lambda i: cat_avgs[i])
-    cat_names = [cat_names[i] for i in sorted_idx]
-    cat_avgs = [cat_avgs[i] for i in sorted_idx]
+    cat_names, cat_avgs = zip(*sorted(((k, v[1] / v[0]) for k, v in agg.items()),
+                                      key=lambda kv: kv[1]))
     
     bars = ax.barh(cat_names, cat_avgs, color='steelblue')
     ax.set_xlabel('Average Binding Affinity (kcal/mol)')
     ax.set_title('Drug Categories Ranked by COVID-19 Mpro Binding')
     
     plt.tight_layout()
-    plt.savefig('output/visualizations/category_ranking.png', dpi=150)
-    print("✅ Saved: category_ranking.png")
+    plt.savefig(path, dpi=150)
+    plt.close(fig)
+    return path
 
-if HAS_RDKIT:
-    print("\n=== Generating Molecule Images ===")
-    
-    # Create grid of top 10 molecules
-    top10 = results[:10]
-    mols = []
-    legends = []
-    
-    for r in top10:
-        mol = Chem.MolFromSmiles(r['smiles'])
-        if mol:
-            mols.append(mol)
-            legends.append(f"{r['name']}\n{r['affinity']:.2f} kcal/mol")
-    
-    if mols:
-        img = Draw.MolsToGridImage(mols, molsPerRow=5, subImgSize=(300, 300), 
-                                    legends=legends, legendFontSize=12)
-        img.save('output/visualizations/top10_structures.png')
-        print("✅ Saved: top10_structures.png")
-    
-    # Individual molecule with highlighted features
-    best = results[0]
-    mol = Chem.MolFromSmiles(best['smiles'])
-    if mol:
+
+# Parse and lay out each SMILES once; the drawers reuse the cached conformer
+@functools.lru_cache(maxsize=None)
+def _mol(smi):
+    mol = Chem.MolFromSmiles(smi)
+    if mol is not None:
         AllChem.Compute2DCoords(mol)
-        img = Draw.MolToImage(mol, size=(500, 500))
-        img.save(f'output/visualizations/best_binder_{best["name"]}.png')
-        print(f"✅ Saved: best_binder_{best['name']}.png")
+    return mol
 
-# Generate HTML report
-print("\n=== Generating HTML Report ===")
 
-html = f'''<!DOCTYPE html>
+# Report templates are parsed once; rows only do a dict lookup per field
+TMPL = string.Template('''<!DOCTYPE html>
 <html>
 <head>
     <title>NEXUS COVID-19 Drug Screen Results</title>
     <style>
-        body {{ font-family: Arial, sans-serif; margin: 40px; background: #f5f5f5; }}
-        .container {{ max-width: 1200px; margin: 0 auto; background: white; padding: 30px; border-radius: 10px; box-shadow: 0 2px 10px rgba(0,0,0,0.1); }}
-        h1 {{ color: #2c3e50; border-bottom: 3px solid #3498db; padding-bottom: 10px; }}
-        h2 {{ color: #34495e; margin-top: 30px; }}
-        .summary {{ background: #ecf0f1; padding: 20px; border-radius: 5px; margin: 20px 0; }}
-        .summary-grid {{ display: grid; grid-template-columns: repeat(4, 1fr); gap: 20px; }}
-        .stat {{ text-align: center; }}
-        .stat-value {{ font-size: 2em; color: #3498db; font-weight: bold; }}
-        .stat-label {{ color: #7f8c8d; }}
-        table {{ width: 100%; border-collapse: collapse; margin: 20px 0; }}
-        th, td {{ padding: 12px; text-align: left; border-bottom: 1px solid #ddd; }}
-        th {{ background: #3498db; color: white; }}
-        tr:hover {{ background: #f5f5f5; }}
-        .good {{ color: #27ae60; }}
-        .bad {{ color: #e74c3c; }}
-        .viz {{ margin: 20px 0; text-align: center; }}
-        .viz img {{ max-width: 100%; border: 1px solid #ddd; border-radius: 5px; }}
-        .footer {{ margin-top: 40px; text-align: center; color: #7f8c8d; }}
+        body { font-family: Arial, sans-serif; margin: 40px; background: #f5f5f5; }
+        .container { max-width: 1200px; margin: 0 auto; background: white; padding: 30px; border-radius: 10px; box-shadow: 0 2px 10px rgba(0,0,0,0.1); }
+        h1 { color: #2c3e50; border-bottom: 3px solid #3498db; padding-bottom: 10px; }
+        h2 { color: #34495e; margin-top: 30px; }
+        .summary { background: #ecf0f1; padding: 20px; border-radius: 5px; margin: 20px 0; }
+        .summary-grid { display: grid; grid-template-columns: repeat(4, 1fr); gap: 20px; }
+        .stat { text-align: center; }
+        .stat-value { font-size: 2em; color: #3498db; font-weight: bold; }
+        .stat-label { color: #7f8c8d; }
+        table { width: 100%; border-collapse: collapse; margin: 20px 0; }
+        th, td { padding: 12px; text-align: left; border-bottom: 1px solid #ddd; }
+        th { background: #3498db; color: white; }
+        tr:hover { background: #f5f5f5; }
+        .good { color: #27ae60; }
+        .bad { color: #e74c3c; }
+        .viz { margin: 20px 0; text-align: center; }
+        .viz img { max-width: 100%; border: 1px solid #ddd; border-radius: 5px; }
+        .footer { margin-top: 40px; text-align: center; color: #7f8c8d; }
     </style>
 </head>
 <body>
@@ -183,19 +231,19 @@ html = f'''<!DOCTYPE html>
         <div class="summary">
             <div class="summary-grid">
                 <div class="stat">
-                    <div class="stat-value">{len(results)}</div>
+                    <div class="stat-value">$n</div>
                     <div class="stat-label">Drugs Screened</div>
                 </div>
                 <div class="stat">
-                    <div class="stat-value">{results[0]['name']}</div>
+                    <div class="stat-value">$top_name</div>
                     <div class="stat-label">Top Binder</div>
                 </div>
                 <div class="stat">
-                    <div class="stat-value">{results[0]['affinity']:.2f}</div>
+                    <div class="stat-value">$top_affinity</div>
                     <div class="stat-label">Best Affinity (kcal/mol)</div>
                 </div>
                 <div class="stat">
-                    <div class="stat-value">{sum(1 for r in results if r['lipinski'])}</div>
+                    <div class="stat-value">$lipinski_count</div>
                     <div class="stat-label">Lipinski Compliant</div>
                 </div>
             </div>
@@ -233,24 +281,22 @@ html = f'''<!DOCTYPE html>
                 <th>Lipinski</th>
                 <th>Category</th>
             </tr>
-'''
+''')
 
-for r in results:
-    lip_icon = '<span class="good">✅</span>' if r['lipinski'] else '<span class="bad">❌</span>'
-    html += f'''
+ROW_TMPL = string.Template('''
             <tr>
-                <td>{r['rank']}</td>
-                <td><strong>{r['name']}</strong></td>
-                <td>{r['affinity']:.2f}</td>
-                <td>{r['qed']:.2f}</td>
-                <td>{r['mw']:.0f}</td>
-                <td>{r['logp']:.1f}</td>
-                <td>{lip_icon}</td>
-                <td>{r['category']}</td>
+                <td>$rank</td>
+                <td><strong>$name</strong></td>
+                <td>$affinity</td>
+                <td>$qed</td>
+                <td>$mw</td>
+                <td>$logp</td>
+                <td>$lipinski</td>
+                <td>$category</td>
             </tr>
-'''
+''')
 
-html += '''
+HTML_TAIL = '''
         </table>
         
         <h2>🔬 Key Findings</h2>
@@ -276,12 +322,109 @@ html += '''
 </html>
 '''
 
-with open('output/visualizations/report.html', 'w') as f:
-    f.write(html)
-print("✅ Saved: report.html")
 
-print("\n" + "=" * 50)
-print("VISUALIZATION COMPLETE")
-print("=" * 50)
-print(f"\nOutput files in: output/visualizations/")
-print("Open report.html in a browser to view the full report")
+def main():
+    # Load results
+    if HAS_ORJSON:
+        with open("data/covid_screen_results.json", "rb") as f:
+            results = orjson.loads(f.read())
+    else:
+        with open("data/covid_screen_results.json") as f:
+            results = json.load(f)
+    
+    print(f"\nLoaded {len(results)} docking results")
+    
+    # Project the records into columns once - every chart below reads these
+    n = len(results)
+    ranks = [r['rank'] for r in results]
+    names = [r['name'] for r in results]
+    categories = [r['category'] for r in results]
+    smiles = [r['smiles'] for r in results]
+    affinity = np.array([r['affinity'] for r in results], dtype=np.float64)
+    qed = np.array([r['qed'] for r in results], dtype=np.float64)
+    mw = np.array([r['mw'] for r in results], dtype=np.float64)
+    logp = np.array([r['logp'] for r in results], dtype=np.float64)
+    lipinski = np.array([r['lipinski'] for r in results], dtype=bool)
+    
+    # Best binders first (more negative = better); does not assume the file is sorted
+    top15 = top_k(affinity, 15)
+    top10 = top15[:10]
+    best = top15[0]
+    
+    # Create output directory
+    os.makedirs("output/visualizations", exist_ok=True)
+    
+    # Charts render in worker processes while the molecule images are drawn here
+    with ProcessPoolExecutor(max_workers=3) as pool:
+        charts = []
+        if HAS_MPL:
+            print("\n=== Generating Charts ===")
+            arrs = {'names': names, 'categories': categories, 'affinity': affinity,
+                    'qed': qed, 'lipinski': lipinski, 'top15': top15}
+            charts = [pool.submit(render, arrs, f'output/visualizations/{fname}')
+                      for render, fname in ((render_top15, 'top15_binders.png'),
+                                            (render_scatter, 'affinity_vs_qed.png'),
+                                            (render_category, 'category_ranking.png'))]
+        
+        if HAS_RDKIT:
+            print("\n=== Generating Molecule Images ===")
+            
+            # Create grid of top 10 molecules
+            mols = []
+            legends = []
+            
+            for i in top10:
+                mol = _mol(smiles[i])
+                if mol:
+                    mols.append(mol)
+                    legends.append(f"{names[i]}\n{affinity[i]:.2f} kcal/mol")
+            
+            if mols:
+                if HAS_CAIROSVG:
+                    # Draw the whole grid as one SVG and rasterize it in a single pass
+                    svg = Draw.MolsToGridImage(mols, molsPerRow=5, subImgSize=(300, 300),
+                                               legends=legends, legendFontSize=12, useSVG=True)
+                    cairosvg.svg2png(bytestring=svg.encode(),
+                                     write_to='output/visualizations/top10_structures.png',
+                                     output_width=1500)
+                else:
+                    img = Draw.MolsToGridImage(mols, molsPerRow=5, subImgSize=(300, 300), 
+                                                legends=legends, legendFontSize=12)
+                    img.save('output/visualizations/top10_structures.png')
+                print("✅ Saved: top10_structures.png")
+            
+            # Individual molecule with highlighted features
+            mol = _mol(smiles[best])
+            if mol:
+                img = Draw.MolToImage(mol, size=(500, 500))
+                img.save(f'output/visualizations/best_binder_{names[best]}.png')
+                print(f"✅ Saved: best_binder_{names[best]}.png")
+        
+        # All charts must be on disk before the report links to them
+        for chart in charts:
+            print(f"✅ Saved: {os.path.basename(chart.result())}")
+    
+    # Generate HTML report
+    print("\n=== Generating HTML Report ===")
+    
+    # Stream head, rows and tail straight to disk - only one row is held at a time
+    with open('output/visualizations/report.html', 'w', buffering=1 << 20) as f:
+        f.write(TMPL.substitute(n=n, top_name=names[best], top_affinity=f'{affinity[best]:.2f}',
+                                lipinski_count=int(lipinski.sum())))
+        for i in range(n):
+            lip_icon = '<span class="good">✅</span>' if lipinski[i] else '<span class="bad">❌</span>'
+            f.write(ROW_TMPL.substitute(
+                rank=ranks[i], name=names[i], affinity=f'{affinity[i]:.2f}', qed=f'{qed[i]:.2f}',
+                mw=f'{mw[i]:.0f}', logp=f'{logp[i]:.1f}', lipinski=lip_icon, category=categories[i]))
+        f.write(HTML_TAIL)
+    print("✅ Saved: report.html")
+    
+    print("\n" + "=" * 50)
+    print("VISUALIZATION COMPLETE")
+    print("=" * 50)
+    print(f"\nOutput files in: output/visualizations/")
+    print("Open report.html in a browser to view the full report")
+
+
+if __name__ == "__main__":
+    main()